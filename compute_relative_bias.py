@@ -1,16 +1,21 @@
 import csv
 import math
 import os
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import open_clip
 import torch
+import torch.nn.functional as F
 import wandb
+from diffusers import DPMSolverMultistepScheduler, StableDiffusionPipeline
+from diffusers.models.attention_processor import AttnProcessor2_0
+from open_clip.constants import OPENAI_DATASET_MEAN, OPENAI_DATASET_STD
 from rtpt import RTPT
+from torchvision import transforms
+from torchvision.transforms.functional import pil_to_tensor
 from transformers import CLIPTextModel
 
-from utils.stable_diffusion_utils import generate
-
 HF_TOKEN = 'INSERT_HF_TOKEN'
 HOMOGLYPHS = [('Greek', 'ο'), ('Cyrillic', 'о'), ('Arabic', 'ه'),
               ('Korean', 'ㅇ'), ('African', 'ọ')]
@@ -21,47 +26,91 @@ TEMPLATES = [('People', 'relative_bias_prompts/template_people.txt'),
 ENCODER_RUN_PATH = None
 OUTPUT_FILE = 'rb_results.csv'
 
+# PIL releases the GIL during decode/convert, so a thread pool scales the
+# per-image tensor conversion across cores
+_POOL = ThreadPool(8)
+
 
 def compute_rcb(model, preprocess, x_clean, x_homoglyph, z_target, batch_size):
-    similarities = []
-    for batch in range(math.ceil(len(x_clean) / batch_size)):
+    device = next(model.parameters()).device
+
+    # the target prompts are a small set replicated num_images times, so
+    # encode each unique prompt once and gather the features by index
+    unique_prompts, inverse = np.unique(z_target, return_inverse=True)
+    text_tokens = open_clip.tokenize(list(unique_prompts)).to(device)
+    with torch.no_grad():
+        text_features = F.normalize(model.encode_text(text_tokens), dim=-1)
+
+    num_batches = math.ceil(len(x_clean) / batch_size)
+    copy_stream = torch.cuda.Stream()
+
+    def upload_batch(batch):
+        # stage both image batches in pinned host memory and copy them to
+        # the device asynchronously on the side stream
         img_clean_batch = x_clean[batch * batch_size:(batch + 1) * batch_size]
         img_homoglyph_batch = x_homoglyph[batch * batch_size:(batch + 1) *
                                           batch_size]
-        img_clean_batch = [
-            preprocess(img).unsqueeze(0) for img in img_clean_batch
-        ]
-        img_homoglyph_batch = [
-            preprocess(img).unsqueeze(0) for img in img_homoglyph_batch
-        ]
-        img_clean_batch = torch.cat(img_clean_batch, dim=0)
-        img_homoglyph_batch = torch.cat(img_homoglyph_batch, dim=0)
-        text_batch = z_target[batch * batch_size:(batch + 1) * batch_size]
-        text_batch = open_clip.tokenize(text_batch)
-
-        with torch.no_grad(), torch.cuda.amp.autocast():
+        img_clean_batch = torch.stack(_POOL.map(pil_to_tensor,
+                                                img_clean_batch)).pin_memory()
+        img_homoglyph_batch = torch.stack(
+            _POOL.map(pil_to_tensor, img_homoglyph_batch)).pin_memory()
+        with torch.cuda.stream(copy_stream):
+            return (img_clean_batch.to(device, non_blocking=True),
+                    img_homoglyph_batch.to(device, non_blocking=True))
+
+    next_batches = upload_batch(0)
+    similarities = []
+    for batch in range(num_batches):
+        torch.cuda.current_stream().wait_stream(copy_stream)
+        img_clean_batch, img_homoglyph_batch = next_batches
+        # mark the copied batches as in use by the consuming stream so
+        # the allocator does not reuse their blocks for a later upload
+        # while the encoder kernels are still reading them
+        img_clean_batch.record_stream(torch.cuda.current_stream())
+        img_homoglyph_batch.record_stream(torch.cuda.current_stream())
+        img_clean_batch = preprocess(img_clean_batch).half()
+        img_homoglyph_batch = preprocess(img_homoglyph_batch).half()
+        with torch.no_grad():
             image_features_clean = model.encode_image(img_clean_batch)
             image_features_homoglyph = model.encode_image(img_homoglyph_batch)
-            text_features = model.encode_text(text_batch)
-
-            for feat_clean, feat_homoglyph, feat_text in zip(
-                    image_features_clean, image_features_homoglyph,
-                    text_features):
-                feat_clean /= feat_clean.norm(dim=-1, keepdim=True)
-                feat_homoglyph /= feat_homoglyph.norm(dim=-1, keepdim=True)
-                feat_text /= feat_text.norm(dim=-1, keepdim=True)
-
-                similarity_clean = (100.0 * feat_clean @ feat_text.T)
-                similarity_homoglyph = (100.0 * feat_homoglyph @ feat_text.T)
-                rcb = 100.0 * (similarity_homoglyph -
-                               similarity_clean) / similarity_clean
-                similarities.append(rcb.cpu().item())
-
-    similarities = np.mean(similarities)
+
+        # prefetch the next batch while the encoder kernels are running
+        if batch + 1 < num_batches:
+            next_batches = upload_batch(batch + 1)
+
+        with torch.no_grad():
+            feat_clean = F.normalize(image_features_clean, dim=-1)
+            feat_homoglyph = F.normalize(image_features_homoglyph, dim=-1)
+            feat_text = text_features[inverse[batch * batch_size:(batch + 1) *
+                                              batch_size]]
+
+            # keep the final reduction in FP32 for numerical stability
+            similarity_clean = 100.0 * (feat_clean *
+                                        feat_text).sum(dim=-1).float()
+            similarity_homoglyph = 100.0 * (feat_homoglyph *
+                                            feat_text).sum(dim=-1).float()
+            rcb = 100.0 * (similarity_homoglyph -
+                           similarity_clean) / similarity_clean
+            similarities.append(rcb.detach().cpu())
+
+    similarities = np.mean(torch.cat(similarities).numpy())
     return similarities
 
 
-def generate_clean_samples(prompt_file, text_encoder, num_images, batch_size):
+def load_pipeline(text_encoder):
+    pipe = StableDiffusionPipeline.from_pretrained(
+        "runwayml/stable-diffusion-v1-5",
+        text_encoder=text_encoder.half(),
+        torch_dtype=torch.float16,
+        use_auth_token=HF_TOKEN).to('cuda')
+    pipe.scheduler = DPMSolverMultistepScheduler.from_config(
+        pipe.scheduler.config, algorithm_type="dpmsolver++", solver_order=2)
+    pipe.unet.set_attn_processor(AttnProcessor2_0())
+    pipe.enable_vae_slicing()
+    return pipe
+
+
+def generate_clean_samples(prompt_file, pipe, num_images, batch_size):
     with open(prompt_file, 'r') as f:
         clean_prompts = f.readlines()
     clean_prompts = [p.replace('\n', '') for p in clean_prompts]
@@ -69,22 +118,19 @@ def generate_clean_samples(prompt_file, text_encoder, num_images, batch_size):
     clean_prompts = [item for item in clean_prompts for i in range(num_images)]
 
     clean_images = []
-    generator = torch.manual_seed(0)
+    generator = torch.Generator(device='cuda').manual_seed(0)
     for batch in range(math.ceil(len(clean_prompts) / batch_size)):
-        clean_images += generate(clean_prompts[batch * batch_size:(batch + 1) *
-                                               batch_size],
-                                 HF_TOKEN,
-                                 text_encoder=text_encoder,
-                                 samples=1,
-                                 num_inference_steps=100,
-                                 guidance_scale=7.5,
-                                 generator=generator)
+        clean_images += pipe(clean_prompts[batch * batch_size:(batch + 1) *
+                                           batch_size],
+                             num_inference_steps=25,
+                             guidance_scale=7.5,
+                             generator=generator).images
         print('Num clean images: ', len(clean_images))
     return clean_images
 
 
-def generate_homoglyph_samples(prompt_file, text_encoder, num_images,
-                               batch_size, homoglyph):
+def generate_homoglyph_samples(prompt_file, pipe, num_images, batch_size,
+                               homoglyph):
     with open(prompt_file, 'r') as f:
         homoglyph_prompts = f.readlines()
     homoglyph_prompts = [p.replace('#', homoglyph) for p in homoglyph_prompts]
@@ -94,16 +140,13 @@ def generate_homoglyph_samples(prompt_file, text_encoder, num_images,
     ]
 
     homoglyph_images = []
-    generator = torch.manual_seed(0)
+    generator = torch.Generator(device='cuda').manual_seed(0)
     for batch in range(math.ceil(len(homoglyph_prompts) / batch_size)):
-        homoglyph_images += generate(
+        homoglyph_images += pipe(
             homoglyph_prompts[batch * batch_size:(batch + 1) * batch_size],
-            HF_TOKEN,
-            text_encoder=text_encoder,
-            samples=1,
-            num_inference_steps=100,
+            num_inference_steps=25,
             guidance_scale=7.5,
-            generator=generator)
+            generator=generator).images
     print('Num homoglyph images: ', len(homoglyph_images))
     return homoglyph_images
 
@@ -143,8 +186,20 @@ def main():
     num_images = 10
     batch_size = 8
 
-    model, _, preprocess = open_clip.create_model_and_transforms(
+    model, _, _ = open_clip.create_model_and_transforms(
         'ViT-H-14', pretrained='laion2b_s32b_b79k')
+    model = model.half().cuda().eval()
+
+    # batched tensor transform applied on the model device instead of
+    # per-image PIL preprocessing on the CPU
+    preprocess = transforms.Compose([
+        transforms.Resize(224,
+                          interpolation=transforms.InterpolationMode.BICUBIC,
+                          antialias=True),
+        transforms.CenterCrop(224),
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Normalize(OPENAI_DATASET_MEAN, OPENAI_DATASET_STD)
+    ])
 
     if ENCODER_RUN_PATH is not None:
         text_encoder = load_wandb_model(ENCODER_RUN_PATH, replace=True)
@@ -152,17 +207,21 @@ def main():
         text_encoder = CLIPTextModel.from_pretrained(
             "openai/clip-vit-large-patch14")
 
-    with open(OUTPUT_FILE, 'a') as f:
-        header_dict = {'People': 0, 'Buildings': 0, 'Misc': 0}
-        w = csv.DictWriter(f, header_dict.keys())
-        w.writeheader()
+    # build the Stable Diffusion pipeline once and reuse it for all
+    # templates and homoglyphs
+    pipe = load_pipeline(text_encoder)
+
+    # open the results file once and reuse a single line-buffered writer
+    f = open(OUTPUT_FILE, 'a', buffering=1)
+    w = csv.DictWriter(f, ['People', 'Buildings', 'Misc'])
+    w.writeheader()
 
     rtpt = RTPT('XX', 'compute_bias', len(HOMOGLYPHS))
     rtpt.start()
 
     clean_sample_dict = {}
     for name, template_prompts in TEMPLATES:
-        clean_samples = generate_clean_samples(template_prompts, text_encoder,
+        clean_samples = generate_clean_samples(template_prompts, pipe,
                                                num_images, batch_size)
         clean_sample_dict[name] = clean_samples
 
@@ -173,8 +232,7 @@ def main():
         for name, template_prompts in TEMPLATES:
 
             homoglyph_samples = generate_homoglyph_samples(
-                template_prompts, text_encoder, num_images, batch_size,
-                homoglyph)
+                template_prompts, pipe, num_images, batch_size, homoglyph)
             target_prompts = get_target_prompts(template_prompts, culture,
                                                 num_images)
 
@@ -183,12 +241,12 @@ def main():
             print(culture, name, rb)
             results[name] = rb
 
-        with open(OUTPUT_FILE, 'a') as f:
-            w = csv.DictWriter(f, results.keys())
-            print(results)
-            w.writerow(results)
+        print(results)
+        w.writerow(results)
         rtpt.step()
 
+    f.close()
+
 
 if __name__ == '__main__':
     main()
@@ -6,9 +6,9 @@ import numpy as np
 import scipy.special
 import scipy.stats
 import torch
+import torch.nn.functional as F
 import transformers
 from multilingual_clip import pt_multilingual_clip
-from sklearn.metrics.pairwise import cosine_similarity
 from transformers import CLIPTextModel, CLIPTokenizer
 
 log.basicConfig(format='%(asctime)s: %(message)s',
@@ -30,27 +30,30 @@ class Test:
         self.A = A
         self.B = B
         self.names = names if names is not None else ["X", "Y", "A", "B"]
+
+        # cache the full pairwise similarity matrix once; shuffled runs
+        # only permute index arrays into it instead of recomputing GEMMs
+        log.info("Computing cosine similarities...")
+        with torch.no_grad():
+            D = F.normalize(torch.cat((X, Y, A, B)), dim=-1)
+            self._full_sim = (D @ D.T).cpu().numpy()
+        num_xy = X.shape[0] + Y.shape[0]
+        self._xy_idx = np.arange(num_xy)
+        self._ab_idx = np.arange(num_xy, self._full_sim.shape[0])
         self.reset_calc()
 
     def reset_calc(self):
-        log.info("Computing cosine similarities...")
         self.similarity_matrix = self.similarities()
         self.s_AB = None
         self.calc_s_AB()
 
     def run(self, randomized=False, **kwargs):
         if randomized:
-            X_orig = self.X
-            Y_orig = self.Y
-            A_orig = self.A
-            B_orig = self.B
-            D = np.concatenate((self.X, self.Y, self.A, self.B))
-            np.random.shuffle(D)
-            self.X = D[:X_orig.shape[0], :]
-            self.Y = D[X_orig.shape[0]:2 * X_orig.shape[0], :]
-            self.A = D[2 * X_orig.shape[0]:2 * X_orig.shape[0] +
-                       A_orig.shape[0], :]
-            self.B = D[2 * X_orig.shape[0] + A_orig.shape[0]:, :]
+            xy_idx_orig = self._xy_idx
+            ab_idx_orig = self._ab_idx
+            permutation = np.random.permutation(self._full_sim.shape[0])
+            self._xy_idx = permutation[:xy_idx_orig.shape[0]]
+            self._ab_idx = permutation[xy_idx_orig.shape[0]:]
             self.reset_calc()
 
         log.info(
@@ -65,17 +68,13 @@ class Test:
         log.info("esize: %g", e)
 
         if randomized:
-            self.X = X_orig
-            self.Y = Y_orig
-            self.A = A_orig
-            self.B = B_orig
+            self._xy_idx = xy_idx_orig
+            self._ab_idx = ab_idx_orig
             self.reset_calc()
         return e, p
 
     def similarities(self):
-        XY = np.concatenate((self.X, self.Y))
-        AB = np.concatenate((self.A, self.B))
-        return cosine_similarity(XY, AB)
+        return self._full_sim[np.ix_(self._xy_idx, self._ab_idx)]
 
     def calc_s_AB(self):
         self.s_AB = self.s_wAB(np.arange(self.similarity_matrix.shape[0]))
@@ -93,8 +92,7 @@ class Test:
     def p(self, n_samples=10000, parametric=False):
         assert self.X.shape[0] == self.Y.shape[0]
         size = self.X.shape[0]
-
-        XY = np.concatenate((self.X, self.Y))
+        num_XY = self.X.shape[0] + self.Y.shape[0]
 
         if parametric:
             log.info('Using parametric test')
@@ -103,15 +101,11 @@ class Test:
                 np.arange(self.X.shape[0], self.X.shape[0] + self.Y.shape[0]))
 
             log.info('Drawing {} samples'.format(n_samples))
-            samples = []
-            for _ in range(n_samples):
-                a = np.arange(XY.shape[0])
-                np.random.shuffle(a)
-                Xi = a[:size]
-                Yi = a[size:]
-                assert len(Xi) == len(Yi)
-                si = self.s_XYAB(Xi, Yi)
-                samples.append(si)
+            # draw all permutations at once and reduce over the
+            # precomputed s_AB values instead of looping in Python
+            perms = np.argsort(np.random.rand(n_samples, num_XY), axis=1)
+            samples = self.s_AB[perms[:, :size]].sum(
+                axis=1) - self.s_AB[perms[:, size:]].sum(axis=1)
 
             log.info('Inferring p-value based on normal distribution')
             (shapiro_test_stat, shapiro_p_val) = scipy.stats.shapiro(samples)
@@ -140,31 +134,28 @@ class Test:
                 log.info(
                     'Drawing {} samples (and biasing by 1)'.format(n_samples -
                                                                    total))
-                for i in range(n_samples - 1):
-                    a = np.arange(XY.shape[0])
-                    np.random.shuffle(a)
-                    Xi = a[:size]
-                    assert 2 * len(Xi) == len(XY)
-                    si = self.s_XAB(Xi)
-                    if si > s:
-                        total_true += 1
-                    elif si == s:  # use conservative test
-                        total_true += 1
-                        total_equal += 1
-                    total += 1
+                # sample all random partitions at once: the first `size`
+                # entries of each random permutation form Xi
+                idx = np.argpartition(np.random.rand(n_samples - 1, num_XY),
+                                      size,
+                                      axis=1)[:, :size]
+                sis = self.s_AB[idx].sum(axis=1)
+                num_equal = int((sis == s).sum())  # use conservative test
+                total_true += int((sis > s).sum()) + num_equal
+                total_equal += num_equal
+                total += sis.shape[0]
             else:
                 log.info(
                     'Using exact test ({} partitions)'.format(num_partitions))
-                for Xi in it.combinations(np.arange(XY.shape[0]),
-                                          self.X.shape[0]):
-                    assert 2 * len(Xi) == len(XY)
-                    si = self.s_XAB(np.array(Xi))
-                    if si > s:
-                        total_true += 1
-                    elif si == s:  # use conservative test
-                        total_true += 1
-                        total_equal += 1
-                    total += 1
+                # enumerate all partitions once into an index matrix and
+                # evaluate them with a single vectorized reduction
+                combinations = np.array(
+                    list(it.combinations(np.arange(num_XY), self.X.shape[0])))
+                sis = self.s_AB[combinations].sum(axis=1)
+                num_equal = int((sis == s).sum())  # use conservative test
+                total_true += int((sis > s).sum()) + num_equal
+                total_equal += num_equal
+                total += sis.shape[0]
 
             if total_equal:
                 log.warning('Equalities contributed {}/{} to p-value'.format(
@@ -190,12 +181,11 @@ def compute_text_embedding(prompts,
             text_embeddings = text_encoder.forward(prompts, tokenizer)
         else:
             text_input = tokenizer(prompts,
-                                   padding="max_length",
-                                   max_length=tokenizer.model_max_length,
+                                   padding=True,
                                    truncation=True,
                                    return_tensors="pt")
             text_embeddings = text_encoder(
-                text_input.input_ids.to('cuda:0')).pooler_output.cpu()
+                text_input.input_ids.to('cuda:0')).pooler_output
 
     return text_embeddings
 
@@ -251,19 +241,31 @@ if __name__ == "__main__":
         text_encoder = CLIPTextModel.from_pretrained(
             "openai/clip-vit-large-patch14").cuda()
 
-    for script in A_homoglyph.keys():
-        A = compute_text_embedding(A_homoglyph[script], tokenizer,
-                                   text_encoder, MULTILINGUAL)
-        B = compute_text_embedding(A_latin, tokenizer, text_encoder,
-                                   MULTILINGUAL)
-        X = compute_text_embedding(T_homoglyph[script], tokenizer,
-                                   text_encoder, MULTILINGUAL)
-        Y = compute_text_embedding(T_latin, tokenizer, text_encoder,
-                                   MULTILINGUAL)
+    # encode all word lists in a single forward pass and slice the result
+    # per script instead of running 4 tiny batches per script
+    scripts = list(A_homoglyph.keys())
+    all_prompts = []
+    offsets = {}
+    for script in scripts:
+        offsets[script] = len(all_prompts)
+        all_prompts += A_homoglyph[script] + T_homoglyph[script]
+    offset_latin = len(all_prompts)
+    all_prompts += A_latin + T_latin
+
+    embeddings = compute_text_embedding(all_prompts, tokenizer, text_encoder,
+                                        MULTILINGUAL)
+    B = embeddings[offset_latin:offset_latin + len(A_latin)]
+    Y = embeddings[offset_latin + len(A_latin):]
+
+    for script in scripts:
+        offset = offsets[script]
+        A = embeddings[offset:offset + len(A_homoglyph[script])]
+        X = embeddings[offset + len(A_homoglyph[script]):offset +
+                       len(A_homoglyph[script]) + len(T_homoglyph[script])]
 
         np.random.seed(1)
 
-        test = Test(X.numpy(), Y.numpy(), A.numpy(), B.numpy())
+        test = Test(X, Y, A, B)
         pval = test.run(n_samples=10000)
         print(
             f'Script: {script}\t Effect size: {pval[0]:.2f}\t p-Value: {pval[1]:.4f}'
@@ -1,7 +1,7 @@
 import os
 
 import torch
-from diffusers import LMSDiscreteScheduler, StableDiffusionPipeline
+from diffusers import DPMSolverMultistepScheduler, StableDiffusionPipeline
 from rtpt import RTPT
 from torch import autocast
 
@@ -15,29 +15,27 @@ SEED = 1
 
 
 def main():
-    lms = LMSDiscreteScheduler(beta_start=0.00085,
-                               beta_end=0.012,
-                               beta_schedule="scaled_linear")
-
     rtpt = RTPT('XX', 'Images', len(HOMOGLYPHS))
     rtpt.start()
 
     pipe = StableDiffusionPipeline.from_pretrained(
-        "runwayml/stable-diffusion-v1-5",
-        scheduler=lms,
-        use_auth_token=HF_TOKEN).to("cuda")
+        "runwayml/stable-diffusion-v1-5", use_auth_token=HF_TOKEN).to("cuda")
+    pipe.scheduler = DPMSolverMultistepScheduler.from_config(
+        pipe.scheduler.config, algorithm_type="dpmsolver++", solver_order=2)
 
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
     for script, c in HOMOGLYPHS:
         prompt = f'A photo {c}f an actress'
         file_name = f'actress_{script}'
-        torch.manual_seed(SEED)
+        generator = torch.Generator('cuda').manual_seed(SEED)
 
-        for i in range(NUM_SAMPLES):
-            with autocast("cuda"):
-                image = pipe(prompt, num_inference_steps=100)["sample"][0]
+        with autocast("cuda"):
+            images = pipe([prompt] * NUM_SAMPLES,
+                          num_inference_steps=25,
+                          generator=generator).images
 
+        for i, image in enumerate(images):
             image.save(f"{OUTPUT_FOLDER}/{file_name}_{i}.jpg")
         rtpt.step()
 
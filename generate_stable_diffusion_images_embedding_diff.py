@@ -1,9 +1,8 @@
 import os
 
 import torch
-from diffusers import AutoencoderKL, LMSDiscreteScheduler, UNet2DConditionModel
+from diffusers import AutoencoderKL, DPMSolverMultistepScheduler, UNet2DConditionModel
 from PIL import Image
-from torch import autocast
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
@@ -21,74 +20,98 @@ SEED = 1
 def main():
     vae = AutoencoderKL.from_pretrained("runwayml/stable-diffusion-v1-5",
                                         subfolder="vae",
+                                        torch_dtype=torch.float16,
                                         use_auth_token=HF_TOKEN)
     tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
     text_encoder = CLIPTextModel.from_pretrained(
-        "openai/clip-vit-large-patch14")
+        "openai/clip-vit-large-patch14", torch_dtype=torch.float16)
     unet = UNet2DConditionModel.from_pretrained(
         "runwayml/stable-diffusion-v1-5",
         subfolder="unet",
+        torch_dtype=torch.float16,
         use_auth_token=HF_TOKEN)
 
-    scheduler = LMSDiscreteScheduler(beta_start=0.00085,
-                                     beta_end=0.012,
-                                     beta_schedule="scaled_linear",
-                                     num_train_timesteps=1000)
+    scheduler = DPMSolverMultistepScheduler(beta_start=0.00085,
+                                            beta_end=0.012,
+                                            beta_schedule="scaled_linear",
+                                            num_train_timesteps=1000,
+                                            algorithm_type="dpmsolver++",
+                                            solver_order=2)
 
     torch_device = "cuda"
     vae.to(torch_device)
     text_encoder.to(torch_device)
     unet.to(torch_device)
 
+    # the UNet runs many times per image at a fixed shape, so compiling
+    # it amortizes quickly; same for the VAE decoder
+    unet = torch.compile(unet, mode="reduce-overhead")
+    vae.decoder = torch.compile(vae.decoder)
+
     os.makedirs('stable_diffusion_images', exist_ok=True)
 
-    def generate_image(PROMPTS, bias_PROMPTS):
+    # the base prompts and the unconditional embedding are identical for
+    # every homoglyph, so encode them once outside the loop
+    prompts = PROMPTS * NUM_SAMPLES
+    batch_size = len(prompts)
+    text_input = tokenizer(prompts,
+                           padding="max_length",
+                           max_length=tokenizer.model_max_length,
+                           truncation=True,
+                           return_tensors="pt")
+    uncond_input = tokenizer([""] * batch_size,
+                             padding="max_length",
+                             max_length=text_input.input_ids.shape[-1],
+                             return_tensors="pt")
+    with torch.no_grad():
+        text_embeddings_base = text_encoder(
+            text_input.input_ids.to(torch_device))[0]
+        uncond_embeddings = text_encoder(
+            uncond_input.input_ids.to(torch_device))[0]
+
+    def generate_image(bias_PROMPTS):
         height = 512
         width = 512
-        num_inference_steps = 100
+        num_inference_steps = 25
         guidance_scale = 7.5
-        batch_size = len(PROMPTS)
 
         text_input_bias = tokenizer(bias_PROMPTS,
                                     padding="max_length",
                                     max_length=tokenizer.model_max_length,
                                     truncation=True,
                                     return_tensors="pt")
-        text_embeddings_bias = text_encoder(
-            text_input_bias.input_ids.to(torch_device))[0]
+        with torch.no_grad():
+            text_embeddings_bias = text_encoder(
+                text_input_bias.input_ids.to(torch_device))[0]
         bias = (text_embeddings_bias[1] - text_embeddings_bias[0]).unsqueeze(0)
 
-        text_input = tokenizer(PROMPTS,
-                               padding="max_length",
-                               max_length=tokenizer.model_max_length,
-                               truncation=True,
-                               return_tensors="pt")
-        text_embeddings = text_encoder(
-            text_input.input_ids.to(torch_device))[0]
-        text_embeddings = (text_embeddings + bias)
-
-        max_length = text_input.input_ids.shape[-1]
-        uncond_input = tokenizer([""] * batch_size,
-                                 padding="max_length",
-                                 max_length=max_length,
-                                 return_tensors="pt")
-        uncond_embeddings = text_encoder(
-            uncond_input.input_ids.to(torch_device))[0]
+        text_embeddings = text_embeddings_base + bias
         text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
 
         latents = torch.randn(
             (batch_size, unet.in_channels, height // 8, width // 8),
             generator=generator,
+            device=torch_device,
+            dtype=torch.float16,
         )
-        latents = latents.to(torch_device)
         scheduler.set_timesteps(num_inference_steps)
-        latents = latents * scheduler.sigmas[0]
+        latents = latents * scheduler.init_noise_sigma
 
-        with autocast("cuda"):
-            for i, t in tqdm(enumerate(scheduler.timesteps)):
+        for i, t in tqdm(enumerate(scheduler.timesteps)):
+            if guidance_scale == 1.0:
+                # no classifier-free guidance, so skip the unconditional
+                # half and run the UNet on the conditional batch only
+                latent_model_input = scheduler.scale_model_input(latents, t)
+                with torch.no_grad():
+                    noise_pred = unet(
+                        latent_model_input,
+                        t,
+                        encoder_hidden_states=text_embeddings[batch_size:]
+                    )["sample"]
+            else:
                 latent_model_input = torch.cat([latents] * 2)
-                sigma = scheduler.sigmas[i]
-                latent_model_input = latent_model_input / ((sigma**2 + 1)**0.5)
+                latent_model_input = scheduler.scale_model_input(
+                    latent_model_input, t)
 
                 with torch.no_grad():
                     noise_pred = unet(
@@ -100,26 +123,27 @@ def main():
                 noise_pred = noise_pred_uncond + guidance_scale * (
                     noise_pred_text - noise_pred_uncond)
 
-                latents = scheduler.step(noise_pred, i, latents).prev_sample
-                torch.cuda.empty_cache()
+            latents = scheduler.step(noise_pred, t, latents).prev_sample
 
+        with torch.no_grad():
             latents = 1 / 0.18215 * latents
             image = vae.decode(latents).sample
-            image = (image / 2 + 0.5).clamp(0, 1)
-            image = image.detach().cpu().permute(0, 2, 3, 1).numpy()
-            images = (image * 255).round().astype("uint8")
-            pil_images = [Image.fromarray(image) for image in images]
-        return pil_images[0]
+        # convert to uint8 on the GPU and transfer one contiguous copy
+        # instead of moving FP32 data and doing the math on the CPU
+        image = ((image / 2 + 0.5).clamp(0, 1) * 255).round().to(
+            torch.uint8).permute(0, 2, 3, 1).contiguous()
+        images = image.cpu().numpy()
+        pil_images = [Image.fromarray(image) for image in images]
+        return pil_images
 
     for script, c in HOMOGLYPHS:
         chars = [LATIN_CHARACTER, c]
         file_name = f'embedding_bias_{script}'
-        generator = torch.manual_seed(SEED)
+        generator = torch.Generator(device='cuda').manual_seed(SEED)
 
-        for i in range(NUM_SAMPLES):
-            with autocast("cuda"):
-                image = generate_image(PROMPTS, chars)
+        images = generate_image(chars)
 
+        for i, image in enumerate(images):
             image.save(f"{OUTPUT_FOLDER}/{file_name}_{i}.jpg")
 
 
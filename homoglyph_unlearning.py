@@ -2,11 +2,16 @@ import argparse
 import os
 from datetime import datetime
 
+# keep the fast tokenizer's threadpool enabled in the loader workers
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
 import torch
 import wandb
 from torch.utils.data import DataLoader
 
 from utils.config_parser import ConfigParser
+from utils.datasets import CleanDataset, HomoglyphDataset
+from utils.prefetcher import TokenizingPrefetcher
 
 
 def main():
@@ -22,22 +27,59 @@ def main():
 
     # load dataset
     dataset = config.load_datasets()
-    dataloader = DataLoader(dataset,
+
+    # datasets already return only valid samples, so the expensive
+    # filtering and substitution runs once in the loader workers instead
+    # of on the main thread every step
+    clean_dataset = CleanDataset(dataset, config.homoglyphs)
+    loader_args = {
+        'num_workers': config.training['dataloader_num_workers'],
+        'pin_memory': True,
+        'persistent_workers': True,
+        'prefetch_factor': 4
+    }
+    dataloader = DataLoader(clean_dataset,
                             batch_size=config.clean_batch_size,
-                            shuffle=True)
+                            shuffle=True,
+                            drop_last=True,
+                            **loader_args)
+    num_poisoned_samples = config.injection['poisoned_samples_per_step']
+    char_loaders = {
+        homoglyph['homoglyph']:
+        DataLoader(HomoglyphDataset(clean_dataset.samples, homoglyph,
+                                    config.injection['homoglyph_count']),
+                   batch_size=num_poisoned_samples,
+                   shuffle=True,
+                   drop_last=True,
+                   **loader_args)
+        for homoglyph in config.homoglyphs
+    }
 
     # load models
     tokenizer = config.load_tokenizer()
     encoder_teacher = config.load_text_encoder().to(device)
     encoder_student = config.load_text_encoder().to(device)
 
-    # freeze teacher model
-    for param in encoder_teacher.parameters():
-        param.requires_grad = False
+    # freeze teacher model and switch it to the inference fastpath
+    encoder_teacher.requires_grad_(False).eval()
+
+    # compile both encoders; the trained student gets the full
+    # autotuning, the frozen teacher the cheaper mode. dynamic=True
+    # keeps the varying sequence lengths of batch-padded prompts from
+    # triggering a recompile per length
+    encoder_student = torch.compile(encoder_student,
+                                    mode="max-autotune",
+                                    dynamic=True)
+    encoder_teacher = torch.compile(encoder_teacher,
+                                    mode="reduce-overhead",
+                                    dynamic=True)
 
     # define optimizer
     optimizer = config.create_optimizer(encoder_student)
     lr_scheduler = config.create_lr_scheduler(optimizer)
+    # cached once; repeated param_groups[0] lookups in the step are
+    # avoidable dict traffic
+    param_group = optimizer.param_groups[0]
 
     # define loss function
     loss_fkt = config.loss_fkt
@@ -49,10 +91,10 @@ def main():
         wandb.watch(encoder_student)
         wandb.config.optimizer = {
             'type': type(optimizer).__name__,
-            'betas': optimizer.param_groups[0]['betas'],
-            'lr': optimizer.param_groups[0]['lr'],
-            'eps': optimizer.param_groups[0]['eps'],
-            'weight_decay': optimizer.param_groups[0]['weight_decay']
+            'betas': param_group['betas'],
+            'lr': param_group['lr'],
+            'eps': param_group['eps'],
+            'weight_decay': param_group['weight_decay']
         }
         wandb.config.injection = config.injection
         wandb.config.training = config.training
@@ -61,151 +103,117 @@ def main():
     # prepare training
     num_clean_samples = 0
     num_homoglyphed_samples = 0
-    step = -1
     encoder_student.train()
-    encoder_teacher.eval()
-    dataloader_iter = iter(dataloader)
+
+    # the prefetcher tokenizes all prompts of the upcoming step in one
+    # call and uploads the input_ids on a side stream while the current
+    # step runs
+    prefetcher = TokenizingPrefetcher(dataloader, char_loaders, tokenizer,
+                                      device)
+
+    # warm up the compiled teacher under the training-time contexts so
+    # the CUDA-graph capture of the reduce-overhead mode runs before the
+    # first step instead of during it
+    torch.cuda.current_stream().wait_stream(prefetcher.stream)
+    for _ in range(3):
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+            with torch.inference_mode():
+                encoder_teacher(prefetcher.next_teacher_ids)
+
+    # losses are buffered on the GPU and only synced to the host every
+    # log_interval steps, so logging does not force a device sync per step
+    log_interval = config.training.get('log_interval', 50)
+    losses_buffer = []
+    lr_buffer = []
 
     # training loop
-    while (True):
-        step += 1
-
-        # stop if max num of steps reached
-        if step >= config.num_steps:
-            break
-
-        # get next clean batch without homoglyph characters
-        batch_clean = []
-        while len(batch_clean) < config.clean_batch_size:
-            try:
-                batch = next(dataloader_iter)
-            except StopIteration:
-                dataloader_iter = iter(dataloader)
-                batch = next(dataloader_iter)
+    for step in range(config.num_steps):
+        # get next clean batch without homoglyph characters together with
+        # the (homoglyph, target) batches of this step
+        (input_ids_clean, char_input_ids, input_ids_teacher,
+         input_ids_homoglyph_all) = prefetcher.next()
+
+        # run the forwards and losses in bf16; bf16 has the FP32 exponent
+        # range, so no gradient scaler is needed and backward stays outside
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+            # one fused teacher forward over the clean and all target
+            # prompts; inference_mode also skips view tracking and
+            # version counters
+            with torch.inference_mode():
+                embedding_teacher_all = encoder_teacher(input_ids_teacher)[0]
+            # inference tensors cannot be saved for backward, so clone the
+            # result into a regular tensor before it enters the loss
+            embedding_teacher_all = embedding_teacher_all.clone()
+
+            # compute utility loss
+            num_clean_samples += input_ids_clean.shape[0]
+            embedding_student = encoder_student(input_ids_clean)[0]
+            embedding_teacher = embedding_teacher_all[:input_ids_clean.
+                                                      shape[0]]
+
+            loss_benign = loss_fkt(embedding_student, embedding_teacher)
+
+            # one fused student forward over all homoglyph prompts
+            embedding_student_homoglyph_all = encoder_student(
+                input_ids_homoglyph_all)[0]
+
+            # compute losses for all homoglyphs
+            homoglyph_losses = []
+            target_offset = input_ids_clean.shape[0]
+            homoglyph_offset = 0
             for homoglyph in config.homoglyphs:
-                batch = [
-                    sample for sample in batch
-                    if homoglyph['homoglyph'] not in sample
-                ]
-
-            batch_clean += batch
-        batch_clean = batch_clean[:config.clean_batch_size]
-
-        # compute utility loss
-        num_clean_samples += len(batch_clean)
-        text_input = tokenizer(batch,
-                               padding="max_length",
-                               max_length=tokenizer.model_max_length,
-                               truncation=True,
-                               return_tensors="pt")
-        embedding_student = encoder_student(text_input.input_ids.to(device))[0]
-        with torch.no_grad():
-            embedding_teacher = encoder_teacher(
-                text_input.input_ids.to(device))[0]
-
-        loss_benign = loss_fkt(embedding_student, embedding_teacher)
-
-        # compute losses for all homoglyphs
-        homoglyph_losses = []
-        for homoglyph in config.homoglyphs:
-
-            # insert homoglyphs into prompts containing the character to be replaced
-            batch_homoglyph = []
-            batch_clean = []
-            num_poisoned_samples = config.injection[
-                'poisoned_samples_per_step']
-            while len(batch_homoglyph) < num_poisoned_samples:
-                try:
-                    batch = next(dataloader_iter)
-                except StopIteration:
-                    dataloader_iter = iter(dataloader)
-                    batch = next(dataloader_iter)
-
-                # remove samples with homoglyphs present
-                for bd in config.homoglyphs:
-                    batch = [
-                        sample for sample in batch
-                        if bd['homoglyph'] not in sample
-                    ]
-
-                batch_clean += [
-                    sample for sample in batch
-                    if homoglyph['replaced_character'] in sample
-                ]
-
-                if config.injection['homoglyph_count']:
-                    samples = [
-                        sample.replace(homoglyph['replaced_character'],
-                                       homoglyph['homoglyph'],
-                                       config.injection['homoglyph_count'])
-                        for sample in batch
-                        if homoglyph['replaced_character'] in sample
-                    ]
-                else:
-                    samples = [
-                        sample.replace(homoglyph['replaced_character'],
-                                       homoglyph['homoglyph'])
-                        for sample in batch
-                        if homoglyph['replaced_character'] in sample
-                    ]
-
-                batch_homoglyph += samples
-                batch_homoglyph = batch_homoglyph[:num_poisoned_samples]
-                batch_clean = batch_clean[:num_poisoned_samples]
-
-            # compute homoglyph loss
-            if config.loss_weight > 0:
-                num_homoglyphed_samples += len(batch_homoglyph)
-            text_input_homoglyph = tokenizer(
-                [sample for sample in batch_homoglyph],
-                padding="max_length",
-                max_length=tokenizer.model_max_length,
-                truncation=True,
-                return_tensors="pt")
-            text_input_target = tokenizer(
-                [sample for sample in batch_clean],
-                padding="max_length",
-                max_length=tokenizer.model_max_length,
-                truncation=True,
-                return_tensors="pt")
-
-            embedding_student_homoglyph = encoder_student(
-                text_input_homoglyph.input_ids.to(device))[0]
-            with torch.no_grad():
-                embedding_teacher_target = encoder_teacher(
-                    text_input_target.input_ids.to(device))[0]
-            homoglyph_losses.append(
-                loss_fkt(embedding_student_homoglyph,
-                         embedding_teacher_target))
+                input_ids_homoglyph, input_ids_target = char_input_ids[
+                    homoglyph['homoglyph']]
+
+                # compute homoglyph loss
+                if config.loss_weight > 0:
+                    num_homoglyphed_samples += input_ids_homoglyph.shape[0]
+
+                embedding_student_homoglyph = embedding_student_homoglyph_all[
+                    homoglyph_offset:homoglyph_offset +
+                    input_ids_homoglyph.shape[0]]
+                embedding_teacher_target = embedding_teacher_all[
+                    target_offset:target_offset + input_ids_target.shape[0]]
+                homoglyph_offset += input_ids_homoglyph.shape[0]
+                target_offset += input_ids_target.shape[0]
+                homoglyph_losses.append(
+                    loss_fkt(embedding_student_homoglyph,
+                             embedding_teacher_target))
 
         # update student model
         if step == 0:
             loss_benign = torch.tensor(0.0).to(device)
 
-        loss_homoglyph = torch.tensor(0.0).to(device)
-        for bd_loss in homoglyph_losses:
-            loss_homoglyph += bd_loss
+        loss_homoglyph = torch.stack(homoglyph_losses).sum()
 
         loss = loss_benign + loss_homoglyph * config.loss_weight
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
         optimizer.step()
 
         # log results
-        loss_benign = loss_benign.detach().cpu().item()
-        loss_homoglyph = loss_homoglyph.detach().cpu().item()
-        loss_total = loss.detach().cpu().item()
-        print(
-            f'Step {step}: Benign Loss: {loss_benign:.4f} \t homoglyph Loss: {loss_homoglyph:.4f} \t Total Loss: {loss_total:.4f}'
-        )
-        if config.wandb['enable_logging']:
-            wandb.log({
-                'Benign Loss': loss_benign,
-                'homoglyph Loss': loss_homoglyph,
-                'Total Loss': loss_total,
-                'Loss Weight': config.loss_weight,
-                'Learning Rate': optimizer.param_groups[0]['lr']
-            })
+        losses_buffer.append(
+            torch.stack((loss_benign.detach(), loss_homoglyph.detach(),
+                         loss.detach())))
+        lr_buffer.append(param_group['lr'])
+        if (step + 1) % log_interval == 0 or step + 1 == config.num_steps:
+            logged_losses = torch.stack(losses_buffer).float().cpu().tolist()
+            first_step = step + 1 - len(losses_buffer)
+            for offset, (loss_benign, loss_homoglyph,
+                         loss_total) in enumerate(logged_losses):
+                print(
+                    f'Step {first_step + offset}: Benign Loss: {loss_benign:.4f} \t homoglyph Loss: {loss_homoglyph:.4f} \t Total Loss: {loss_total:.4f}'
+                )
+                if config.wandb['enable_logging']:
+                    wandb.log({
+                        'Benign Loss': loss_benign,
+                        'homoglyph Loss': loss_homoglyph,
+                        'Total Loss': loss_total,
+                        'Loss Weight': config.loss_weight,
+                        'Learning Rate': lr_buffer[offset]
+                    })
+            losses_buffer = []
+            lr_buffer = []
 
         # update rtpt and lr scheduler
         rtpt.step()
@@ -7,7 +7,7 @@ import yaml
 from datasets import load_dataset
 from rtpt.rtpt import RTPT
 from torch.nn.functional import cosine_similarity
-from transformers import CLIPTextModel, CLIPTokenizer
+from transformers import AutoTokenizer, CLIPTextModel
 
 
 class ConfigParser:
@@ -18,7 +18,9 @@ class ConfigParser:
         self._config = config
 
     def load_tokenizer(self):
-        tokenizer = CLIPTokenizer.from_pretrained(self._config['tokenizer'])
+        # the fast Rust tokenizer parallelizes whole batches internally
+        tokenizer = AutoTokenizer.from_pretrained(self._config['tokenizer'],
+                                                  use_fast=True)
         return tokenizer
 
     def load_text_encoder(self):
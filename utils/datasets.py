@@ -0,0 +1,53 @@
+import re
+
+from torch.utils.data import Dataset
+
+
+class CleanDataset(Dataset):
+    """Prompts that contain none of the homoglyph characters."""
+
+    def __init__(self, samples, homoglyphs):
+        # one compiled-regex pass over each sample instead of a separate
+        # substring scan per homoglyph character
+        pattern = re.compile('|'.join(
+            re.escape(homoglyph['homoglyph']) for homoglyph in homoglyphs))
+        self.samples = [
+            sample for sample in samples if not pattern.search(sample)
+        ]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        return self.samples[index]
+
+
+class HomoglyphDataset(Dataset):
+    """Clean prompts containing the character to be replaced, returned as
+    (homoglyph prompt, target prompt) pairs with the substitution already
+    applied."""
+
+    def __init__(self, samples, homoglyph, homoglyph_count=None):
+        self.replaced_character = homoglyph['replaced_character']
+        self.homoglyph = homoglyph['homoglyph']
+        self.homoglyph_count = homoglyph_count
+        # str.translate with a precomputed table runs in C without
+        # rescanning for the pattern; replace(count) is only needed when
+        # the number of substitutions is limited
+        self.translation = str.maketrans(self.replaced_character,
+                                         self.homoglyph)
+        self.samples = [
+            sample for sample in samples if self.replaced_character in sample
+        ]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        target = self.samples[index]
+        if self.homoglyph_count:
+            sample = target.replace(self.replaced_character, self.homoglyph,
+                                    self.homoglyph_count)
+        else:
+            sample = target.translate(self.translation)
+        return sample, target
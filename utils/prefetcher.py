@@ -0,0 +1,79 @@
+import itertools
+
+import torch
+
+
+class TokenizingPrefetcher:
+    """Draws the clean batch and all (homoglyph, target) batches for the
+    upcoming step, tokenizes every prompt in a single tokenizer call and
+    copies the resulting input_ids to the device on a side CUDA stream, so
+    the transfer overlaps with the compute of the current step."""
+
+    def __init__(self, clean_dataloader, char_dataloaders, tokenizer, device):
+        self.char_dataloaders = char_dataloaders
+        self.tokenizer = tokenizer
+        self.device = device
+        self.stream = torch.cuda.Stream()
+        self.clean_iter = itertools.cycle(clean_dataloader)
+        self.char_iters = {
+            char: itertools.cycle(loader)
+            for char, loader in char_dataloaders.items()
+        }
+        self.preload()
+
+    def preload(self):
+        # collect all prompts of the step as [clean, targets..., homoglyphs...]
+        # and tokenize them with a single call
+        prompts = list(next(self.clean_iter))
+        sections = [len(prompts)]
+        homoglyph_prompts = []
+        homoglyph_sections = []
+        for char in self.char_dataloaders:
+            batch_homoglyph, batch_target = next(self.char_iters[char])
+            prompts += list(batch_target)
+            homoglyph_prompts += list(batch_homoglyph)
+            sections.append(len(batch_target))
+            homoglyph_sections.append(len(batch_homoglyph))
+        prompts += homoglyph_prompts
+        sections += homoglyph_sections
+
+        # pad to the longest prompt of the step (rounded for tensor-core
+        # alignment) instead of always running at model_max_length
+        input_ids = self.tokenizer(prompts,
+                                   padding=True,
+                                   pad_to_multiple_of=8,
+                                   max_length=self.tokenizer.model_max_length,
+                                   truncation=True,
+                                   return_tensors="pt").input_ids
+        # tokenizer outputs live in pageable memory; pinning them first
+        # lets the copy run asynchronously at full transfer bandwidth
+        input_ids = input_ids.pin_memory()
+        with torch.cuda.stream(self.stream):
+            input_ids = input_ids.to(self.device, non_blocking=True)
+
+        splits = torch.split(input_ids, sections)
+        num_chars = len(self.char_dataloaders)
+        num_teacher = sections[0] + sum(sections[1:1 + num_chars])
+        self.next_clean_ids = splits[0]
+        self.next_char_ids = {
+            char: (splits[1 + num_chars + index], splits[1 + index])
+            for index, char in enumerate(self.char_dataloaders)
+        }
+        # contiguous views for fused forward passes: the teacher consumes
+        # the clean and all target prompts, the student all homoglyphs
+        self.next_teacher_ids = input_ids[:num_teacher]
+        self.next_homoglyph_ids = input_ids[num_teacher:]
+
+    def next(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        # mark the storage as in use by the consuming stream so the
+        # caching allocator does not hand the block back to the side
+        # stream while queued forwards are still reading it; recording
+        # one view covers the shared storage of all splits
+        self.next_clean_ids.record_stream(torch.cuda.current_stream())
+        clean_ids = self.next_clean_ids
+        char_ids = self.next_char_ids
+        teacher_ids = self.next_teacher_ids
+        homoglyph_ids = self.next_homoglyph_ids
+        self.preload()
+        return clean_ids, char_ids, teacher_ids, homoglyph_ids
@@ -1,7 +1,7 @@
 from typing import List
 
 import torch
-from diffusers import AutoencoderKL, LMSDiscreteScheduler, UNet2DConditionModel
+from diffusers import AutoencoderKL, DPMSolverMultistepScheduler, UNet2DConditionModel
 from PIL import Image
 from torch import autocast
 from tqdm.auto import tqdm
@@ -16,7 +16,7 @@ def generate(prompt: List[int],
              vae=None,
              tokenizer=None,
              samples: int = 1,
-             num_inference_steps: int = 50,
+             num_inference_steps: int = 25,
              guidance_scale: float = 7.5,
              height: int = 512,
              width: int = 512,
@@ -44,11 +44,13 @@ def generate(prompt: List[int],
         subfolder="unet",
         use_auth_token=hf_auth_token)
 
-    # define K-LMS scheduler
-    scheduler = LMSDiscreteScheduler(beta_start=0.00085,
-                                     beta_end=0.012,
-                                     beta_schedule="scaled_linear",
-                                     num_train_timesteps=1000)
+    # define DPM-Solver++ scheduler
+    scheduler = DPMSolverMultistepScheduler(beta_start=0.00085,
+                                            beta_end=0.012,
+                                            beta_schedule="scaled_linear",
+                                            num_train_timesteps=1000,
+                                            algorithm_type="dpmsolver++",
+                                            solver_order=2)
 
     # move everything to GPU
     torch_device = "cuda"
@@ -94,15 +96,15 @@ def generate(prompt: List[int],
 
     # initialize scheduler
     scheduler.set_timesteps(num_inference_steps)
-    latents = latents * scheduler.sigmas[0]
+    latents = latents * scheduler.init_noise_sigma
 
     # perform denoising loop
     with autocast("cuda"):
         for i, t in tqdm(enumerate(scheduler.timesteps)):
             # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
             latent_model_input = torch.cat([latents] * 2)
-            sigma = scheduler.sigmas[i]
-            latent_model_input = latent_model_input / ((sigma**2 + 1)**0.5)
+            latent_model_input = scheduler.scale_model_input(
+                latent_model_input, t)
 
             # predict the noise residual
             with torch.no_grad():
@@ -116,7 +118,7 @@ def generate(prompt: List[int],
                 noise_pred_text - noise_pred_uncond)
 
             # compute the previous noisy sample x_t -> x_t-1
-            latents = scheduler.step(noise_pred, i, latents).prev_sample
+            latents = scheduler.step(noise_pred, t, latents).prev_sample
 
         with torch.no_grad():
             latents = 1 / 0.18215 * latents